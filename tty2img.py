@@ -7,21 +7,26 @@ Should be imported as a module and contains functions:
 Requires:
   * PIL (https://pypi.org/project/Pillow/) image library
   * pyte (https://pypi.org/project/pyte/) VTXXX terminal emulator
-  * fclist (https://pypi.org/project/fclist-cffi/) fontconfig wrapper
-    (optional, for support fallback fonts)
+  * numpy (https://pypi.org/project/numpy/) array computing
   * freetype (https://pypi.org/project/freetype-py/) freetype wrapper
+  * fclist (https://pypi.org/project/fclist-cffi/) fontconfig wrapper
     (optional, for support fallback fonts)
 
 Copyright © 2020-2021, Robert Ryszard Paciorek <rrp@opcode.eu.org>,
                        MIT licence
 '''
 
-from PIL import Image, ImageDraw, ImageFont, ImageColor
+from PIL import Image, ImageFont, ImageColor
+import numpy as np
 import copy
 import functools
+import string
 import pyte
 
-# import fclist
+try:
+    import fclist
+except ImportError:
+    fclist = None
 import freetype
 
 class tty2img:
@@ -74,8 +79,9 @@ class tty2img:
         marginSize : int, optional
             margin size (left = right = top = bottom) for rendered screen
         antialiasing : int, optional
-            antialiasing level, when greater than 1 rendered image
-            will be antialiasing times greater ans scale down
+            unused, kept for compatibility (glyphs are always rendered
+            with FreeType antialiasing at target size, so rendering
+            at greater size and scaling down is not needed)
         showCursor : bool, optional
             when true (and screen.cursor.hidden is false) mark cursor position
             by reverse foreground background color on it
@@ -87,39 +93,25 @@ class tty2img:
         -------
             PIL.Image
                 with rendered terminal screen
+                (this same image object is reused by next render call,
+                so it should be copied when needed after that call
+                and should not be modified, because only changed lines
+                are redrawn on it)
         '''
-        self.antialiasing = antialiasing
-        if antialiasing > 1:
-            self.lineSpace    = lineSpace * antialiasing
-            self.marginSize   = marginSize * antialiasing
-            self.fontSize     = fontSize * antialiasing
-        else:
-            self.lineSpace    = lineSpace
-            self.marginSize   = marginSize
-            self.fontSize     = fontSize
+        self.lineSpace    = lineSpace
+        self.marginSize   = marginSize
+        self.fontSize     = fontSize
 
         # Recalc fontsize to ensure it fits nicely.
-        for i in range(8, 64):
-            f = ImageFont.truetype(fontName, i)
-            cw, _ = f.getsize('X')
-            ch    = sum(f.getmetrics()) + lineSpace
-            iw = cw * screen.columns + 2*marginSize
-            ih = ch * screen.lines + 2*marginSize
-            print(i, ih, iw)
-            if iw > 1920 or ih > 1080:
-                fontSize = i
-                break
+        fontSize = _fitFontSize(fontName, screen.columns, screen.lines, lineSpace, marginSize, fontSize)
 
         # font settings
-        self.normalFont      = [ ImageFont.truetype(fontName, fontSize), None ]
-        self.boldFont        = [ ImageFont.truetype(boldFontName, fontSize), None ]
-        self.italicsFont     = [ ImageFont.truetype(italicsFontName, fontSize), None ]
-        self.boldItalicsFont = [ ImageFont.truetype(boldItalicsFontName, fontSize), None ]
+        fonts = [ _loadFont(f, fontSize) for f in (fontName, boldFontName, italicsFontName, boldItalicsFontName) ]
+        fonts = [ (f, _loadFace(f.path)) for f in fonts ]
+        self.normalFont, self.boldFont, self.italicsFont, self.boldItalicsFont = fonts
 
-        self.normalFont[1]      = freetype.Face(self.normalFont[0].path)
-        self.boldFont[1]        = freetype.Face(self.boldFont[0].path)
-        self.italicsFont[1]     = freetype.Face(self.italicsFont[0].path)
-        self.boldItalicsFont[1] = freetype.Face(self.boldItalicsFont[0].path)
+        self.fallbackFonts = tuple(fallbackFonts)
+        self.logFunction   = logFunction
 
         # calculate single char and image size
         self.charWidth, _ = self.normalFont[0].getsize('X')
@@ -127,112 +119,315 @@ class tty2img:
         self.imgWidth     = 1920 # charWidth  * screen.columns + 2*marginSize
         self.imgHeight    = 1080 # charHeight * screen.lines + 2*marginSize
 
-
-        # cols/lines should have been
+        # cells positions (colX has extra item for cursor after last column)
+        self._colX = (np.arange(screen.columns + 1) * self.charWidth + self.marginSize).tolist()
+        self._rowY = (np.arange(screen.lines) * self.charHeight + self.marginSize).tolist()
 
         # create image object
         self.bgDefaultColor = bgDefaultColor
         self.fgDefaultColor = fgDefaultColor
-        self.base_image = Image.new('RGBA', (self.imgWidth, self.imgHeight), self.bgDefaultColor)
-        self.base_draw = ImageDraw.Draw(self.base_image)
+        self.bgDefaultColorRGBA = _convertColor(self.bgDefaultColor)
+        self.fgDefaultColorRGBA = _convertColor(self.fgDefaultColor)
+
+        # frame buffer and image reused between render calls
+        # (buffer is cleared via uint32 view, which is much faster than
+        # broadcasting RGBA tuple over 4 channels)
+        self._buffer         = np.empty((self.imgHeight, self.imgWidth, 4), np.uint8)
+        self._bufferPixels   = self._buffer.view(np.uint32).reshape(self.imgHeight, self.imgWidth)
+        self._bgDefaultPixel = np.array(self.bgDefaultColorRGBA, np.uint8).view(np.uint32)[0]
+        self._image          = Image.new('RGBA', (self.imgWidth, self.imgHeight))
         self.showCursor = showCursor
 
+        # lines state (cursor column, line content) drawn on self._image,
+        # None when full image need to be redrawn
+        self._prevLines = None
+
+        # cell styles and rendered glyphs caches (kept for all render calls),
+        # glyphs cache is prefilled with printable ASCII
+        # and chars already on screen, so also fallback fonts for these chars
+        # are resolved here (not while rendering frames)
+        self._cellStyle = functools.lru_cache(maxsize=1024)(self._cellStyle)
+        self._getGlyph  = functools.lru_cache(maxsize=4096)(self._getGlyph)
+        chars = set(string.printable.strip())
+        for row in screen.buffer.values():
+            chars.update(cData.data for cData in row.values())
+        chars.discard("")
+        for font in fonts:
+            for char in sorted(chars):
+                self._getGlyph(font, char)
+
+    def _cellStyle(self, fg, bg, bold, italics, reverse):
+        '''Return (bgColor, fgColor, font) for cell attributes
+
+        bgColor is None for default background color,
+        reverse should be true for reversed cell and for cursor position
+        (but not for reversed cell on cursor position)
+        '''
+        bgColor = bg if bg != 'default' else self.bgDefaultColor
+        fgColor = fg if fg != 'default' else self.fgDefaultColor
+
+        if reverse:
+            bgColor, fgColor = fgColor, bgColor
 
-    @functools.lru_cache()
-    def memofont(self, font0, font1, char):
-        font = [font0, font1]
-        extraWidth = 0
-        if not font[1].get_char_index(char):
-            foundFont = False
-            for fname in fallbackFonts:
-                for ff in fclist.fclist(family=fname, charset=hex(ord(cData.data))):
-                    foundFont = True
-                    font = [ ImageFont.truetype(ff.file, fontSize), None ]
-                    extraWidth = max(0, font[0].getsize(cData.data)[0] - self.charWidth)
-                    break
-                if foundFont:
-                    break
-            else:
-                if logFunction:
-                    logFunction("Missing glyph for " + hex(ord(cData.data)) + " Unicode symbols (" + cData.data + ")")
-        return (extraWidth, font)
+        bgColor = _convertColor(bgColor)
+        fgColor = _convertColor(fgColor)
+
+        if bgColor == self.bgDefaultColorRGBA:
+            bgColor = None
+
+        # set font (bold / italics)
+        if bold and italics:
+            return (bgColor, fgColor, self.boldItalicsFont)
+        elif bold:
+            return (bgColor, fgColor, self.boldFont)
+        elif italics:
+            return (bgColor, fgColor, self.italicsFont)
+        else:
+            return (bgColor, fgColor, self.normalFont)
+
+    def _getGlyph(self, font, char):
+        '''Return (mask, xOffset, extraWidth) for char rendered with font
+
+        mask is 'L' mode image with glyph coverage, used for paste
+        foreground color on rendered image at cell position + xOffset,
+        so this same mask is used for all colors (memoized in __init__,
+        so rendered only once for each font and char)
+        '''
+        extraWidth, font = _resolveFont(font, char, self.charWidth, self.fallbackFonts, self.logFunction)
+        mask, xOffset = self._rasterizeGlyph(font, char, self.charWidth + extraWidth)
+        return (Image.fromarray(mask), xOffset, extraWidth)
+
+    def _rasterizeGlyph(self, font, char, width):
+        '''Return (mask, xOffset) with char glyph mask as uint8 numpy array
+
+        glyph is rendered by freetype directly into numpy array
+        (face is shared between fonts sizes, so size is set on each call),
+        for combining sequences (char with more than one codepoint) glyphs
+        of all codepoints are drawn at this same position (like in xterm)
+
+        mask has charHeight rows (glyph is clipped to line height) and covers
+        cell width and horizontal glyph overhang (e.g. italics, box drawing),
+        xOffset (<= 0) is position of mask left edge relative to cell
+        '''
+        face = font[1]
+        face.set_pixel_sizes(0, font[0].size)
+        ascent = font[0].getmetrics()[0]
+        glyphs = []
+        for codepoint in char:
+            face.load_char(ord(codepoint), freetype.FT_LOAD_RENDER)
+            bitmap = face.glyph.bitmap
+            if bitmap.rows == 0 or bitmap.width == 0:
+                continue
+            glyph = _bitmapToArray(bitmap)
+            glyphs.append((glyph, face.glyph.bitmap_left, ascent - face.glyph.bitmap_top))
+
+        xOffset = min([0] + [x for glyph, x, y in glyphs])
+        xEnd    = max([width] + [x + glyph.shape[1] for glyph, x, y in glyphs])
+        mask = np.zeros((self.charHeight, xEnd - xOffset), np.uint8)
+
+        # place glyphs on baseline and clip them to line height
+        for glyph, x, y in glyphs:
+            x0, x1 = x - xOffset, x - xOffset + glyph.shape[1]
+            y0, y1 = max(y, 0), min(y + glyph.shape[0], self.charHeight)
+            if y0 < y1:
+                np.maximum(mask[y0:y1, x0:x1], glyph[y0-y:y1-y], out=mask[y0:y1, x0:x1])
+        return (mask, xOffset)
 
     def render(self, screen):
-        image = self.base_image.copy()
-        draw = ImageDraw.Draw(image)
+        # background, underscore and strikethrough are collected as runs
+        # of adjacent cells with this same color and filled directly in numpy
+        # buffer (one store per run), text is drawn on image created from it
+        # only lines changed from previous call are redrawn
+        bg = self._buffer
+        glyphs, bgRuns, underscoreRuns, strikethroughRuns = [], [], [], []
+
+        # values constant for all render calls are bound to locals
+        # to avoid attribute lookups in per line and per cell code
+        charWidth, charHeight = self.charWidth, self.charHeight
+        colX, columns = self._colX, len(self._colX) - 1
+        bufferPixels, bgDefaultPixel = self._bufferPixels, self._bgDefaultPixel
+        cellStyle, getGlyph = self._cellStyle, self._getGlyph
+
+        dirtyLines = []
+        fullRedraw = self._prevLines is None
+        if fullRedraw:
+            bufferPixels.fill(bgDefaultPixel)
+            self._prevLines = {}
 
         # cursor settings
-        self.showCursor = self.showCursor and (not screen.cursor.hidden)
+        showCursor = self.showCursor and (not screen.cursor.hidden)
+
+        # draw changed lines to image
+        for line, y in enumerate(self._rowY):
+            # check for changes
+            cursorX = screen.cursor.x if showCursor and line == screen.cursor.y else -1
+            row = screen.buffer.get(line, {})
+            if self._prevLines.get(line) == (cursorX, row):
+                continue
+            self._prevLines[line] = (cursorX, dict(row))
+
+            # clear line
+            yBottom = y + charHeight
+            bufferPixels[y:yBottom].fill(bgDefaultPixel)
+            if dirtyLines and dirtyLines[-1][1] == y:
+                dirtyLines[-1][1] = yBottom
+            else:
+                dirtyLines.append([y, yBottom])
 
-        # draw full screen to image
-        for line in screen.buffer:
             # process all characters in line
-            point, char, lchar = [self.marginSize, line*self.charHeight + self.marginSize], -1, -1
-            for char in sorted(screen.buffer[line].keys()):
-                cData = screen.buffer[line][char]
-
-                # check for skipped chars (e.g. when use \t)
-                point[0] += self.charWidth * (char - lchar - 1)
-                lchar = char
+            # (shift is extra offset after wide glyphs from fallback fonts)
+            shift = 0
+            underscoreY, strikethroughY = yBottom - 1, y + charHeight//2
+            for char in range(columns):
+                cData = row.get(char)
+                if cData is None:
+                    continue
 
                 # check for empty char (bug in pyte?)
                 if cData.data == "":
+                    shift -= charWidth
                     continue
 
-                # set colors and draw background
-                bgColor = cData.bg if cData.bg != 'default' else self.bgDefaultColor
-                fgColor = cData.fg if cData.fg != 'default' else self.fgDefaultColor
-
-                if cData.reverse:
-                    bgColor, fgColor = fgColor, bgColor
-
-                if self.showCursor and line == screen.cursor.y and char == screen.cursor.x:
-                    bgColor, fgColor = fgColor, bgColor
-
-                bgColor = _convertColor(bgColor)
-                fgColor = _convertColor(fgColor)
+                x = colX[char] + shift
 
-                if bgColor != self.bgDefaultColor:
-                    draw.rectangle( ((point[0], point[1]), (point[0] + self.charWidth, point[1] + self.charHeight)), fill=bgColor )
+                # set colors, font and draw background
+                bgColor, fgColor, font = cellStyle(cData.fg, cData.bg, cData.bold, cData.italics, cData.reverse != (char == cursorX))
 
-                # set font (bold / italics)
-                if cData.bold and cData.italics:
-                    font = self.boldItalicsFont
-                elif cData.bold:
-                    font = self.boldFont
-                elif cData.italics:
-                    font = self.italicsFont
-                else:
-                    font = self.normalFont
+                if bgColor:
+                    _addRun(bgRuns, y, yBottom, x, x + charWidth, bgColor)
 
-                # does font have this char?
-                (extraWidth, font) = self.memofont(font[0], font[1], cData.data)
-
-                # draw underscore and strikethrough
+                # underscore and strikethrough
                 if cData.underscore:
-                    draw.line(((point[0], point[1] + self.charHeight-1), (point[0] + self.charWidth, point[1] + self.charHeight-1)), fill=fgColor)
+                    _addRun(underscoreRuns, underscoreY, underscoreY + 1, x, x + charWidth, fgColor)
 
                 if cData.strikethrough:
-                    draw.line(((point[0], point[1] + self.charHeight//2), (point[0] + self.charWidth, point[1] + self.charHeight//2)), fill=fgColor)
+                    _addRun(strikethroughRuns, strikethroughY, strikethroughY + 1, x, x + charWidth, fgColor)
 
-                # draw text
-                draw.text(point, cData.data, fill=fgColor, font=font[0])
+                # space (the most common char) has empty glyph, so skip it
+                if cData.data == " ":
+                    continue
 
-                # update next char position
-                point[0] += self.charWidth + extraWidth
+                # get rendered glyph (use fallback font when font don't have this char)
+                (mask, xOffset, extraWidth) = getGlyph(font, cData.data)
 
-            # draw cursor when it is out of text range
-            if self.showCursor and line == screen.cursor.y and (not screen.cursor.x in screen.buffer[line]):
-                point[0] += (screen.cursor.x - char - 1) * self.charWidth
-                draw.rectangle( ((point[0], point[1]), (point[0] + self.charWidth, point[1] + self.charHeight)), fill=self.fgDefaultColor )
+                # text
+                glyphs.append((mask, fgColor, x + xOffset, y))
 
-        # return image
-        if self.antialiasing > 1:
-            return image.resize((self.imgWidth//self.antialiasing, self.imgHeight//self.antialiasing), Image.ANTIALIAS)
-        else:
-            return image
+                # update next chars position
+                shift += extraWidth
 
+            # draw cursor when it is out of text range
+            if cursorX >= 0 and (not cursorX in row):
+                x = colX[cursorX] + shift
+                _addRun(bgRuns, y, yBottom, x, x + charWidth, self.fgDefaultColorRGBA)
+
+        # draw background, underscore and strikethrough (over background)
+        for y0, y1, x0, x1, color in _mergeRuns(bgRuns) + underscoreRuns + strikethroughRuns:
+            bg[y0:y1, x0:x1] = color
+
+        # copy changed lines (or full buffer) to image and draw text
+        # (this is done serially: per glyph cost is mostly Python overhead
+        # of PIL calls holding the GIL, so threads don't speed it up,
+        # and shared freetype faces used on glyph cache miss are not
+        # thread safe)
+        image = self._image
+        if fullRedraw:
+            image.frombytes(bg)
+        else:
+            for y0, y1 in dirtyLines:
+                image.paste(Image.fromarray(bg[y0:y1]), (0, y0))
+        for mask, fgColor, x, y in glyphs:
+            image.paste(fgColor, (x, y), mask)
+
+        return image
+
+def _bitmapToArray(bitmap):
+    '''Convert freetype bitmap to (rows, width) uint8 numpy array with coverage
+    (1-bit MONO bitmaps, e.g. from fonts with embedded bitmap strikes,
+    are unpacked to 0 / 255 values)'''
+    buffer = np.array(bitmap.buffer, np.uint8).reshape(bitmap.rows, bitmap.pitch)
+    if bitmap.pixel_mode == freetype.FT_PIXEL_MODE_MONO:
+        return np.unpackbits(buffer, axis=1)[:, :bitmap.width] * np.uint8(255)
+    return buffer[:, :bitmap.width]
+
+@functools.lru_cache(maxsize=512)
 def _convertColor(color):
+    '''Convert pyte color (name or hex value without #) to RGBA tuple'''
     if color[0] != "#" and not color in ImageColor.colormap:
-        return "#" + color
-    return color
+        color = "#" + color
+    return ImageColor.getcolor(color, 'RGBA')
+
+def _addRun(runs, y0, y1, x0, x1, color):
+    '''Add rectangle [y0:y1, x0:x1] filled with color to runs list,
+    merge it with last run when it is directly after it in this same line'''
+    if runs:
+        last = runs[-1]
+        if last[3] == x0 and last[0] == y0 and last[4] == color:
+            last[3] = x1
+            return
+    runs.append([y0, y1, x0, x1, color])
+
+def _mergeRuns(runs):
+    '''Merge runs with this same columns range and color from adjacent lines
+    (e.g. multiline color blocks) into single rectangles'''
+    merged, lastRuns = [], {}
+    for run in runs:
+        key = (run[2], run[3], run[4])
+        last = lastRuns.get(key)
+        if last and last[1] == run[0]:
+            last[1] = run[1]
+        else:
+            merged.append(run)
+            lastRuns[key] = run
+    return merged
+
+@functools.lru_cache(maxsize=None)
+def _loadFont(fontName, fontSize):
+    return ImageFont.truetype(fontName, fontSize, layout_engine=ImageFont.Layout.BASIC)
+
+@functools.lru_cache(maxsize=32)
+def _loadFace(fontPath):
+    return freetype.Face(fontPath)
+
+@functools.lru_cache(maxsize=None)
+def _resolveFont(font, char, charWidth, fallbackFonts, logFunction):
+    '''Return (extraWidth, font) to use for rendering char
+
+    When font (tuple of ImageFont and freetype.Face) don't have glyph for char
+    return first font from fallbackFonts families that have it (require fclist)
+    and extra width (over charWidth) needed for this glyph.
+    For combining sequences (char with more than one codepoint) font
+    is selected by base (first) codepoint.
+    '''
+    if font[1].get_char_index(ord(char[0])):
+        return (0, font)
+    if fclist:
+        for fname in fallbackFonts:
+            for ff in fclist.fclist(family=fname, charset=hex(ord(char[0]))):
+                fallbackFont = _loadFont(ff.file, font[0].size)
+                extraWidth = max(0, fallbackFont.getsize(char[0])[0] - charWidth)
+                return (extraWidth, (fallbackFont, _loadFace(ff.file)))
+    if logFunction:
+        logFunction("Missing glyph for " + hex(ord(char[0])) + " Unicode symbols (" + char + ")")
+    return (0, font)
+
+def _fitFontSize(fontName, columns, lines, lineSpace, marginSize, fontSize):
+    '''Return smallest font size in range 8..63 for which rendered screen
+    is greater than 1920x1080 (or fontSize when there is no such size)
+
+    Image size grows with font size, so binary search is used to load only
+    a few font sizes instead of all of them.
+    '''
+    low, high = 8, 64
+    while low < high:
+        size = (low + high) // 2
+        f = _loadFont(fontName, size)
+        cw, _ = f.getsize('X')
+        ch    = sum(f.getmetrics()) + lineSpace
+        iw = cw * columns + 2*marginSize
+        ih = ch * lines + 2*marginSize
+        if iw > 1920 or ih > 1080:
+            high = size
+        else:
+            low = size + 1
+    return low if low < 64 else fontSize